@@ -0,0 +1,410 @@
+import math
+from fractions import Fraction
+from functools import lru_cache
+
+import torch
+import torch.nn as nn
+import torchaudio.functional as AF
+import torchaudio.transforms as T
+
+"""
+Batched, GPU-friendly audio augmentations used to build the positive sample of a triplet.
+
+Every transform takes a batch of waveforms of shape (batch, channels, time) and returns a
+batch of the same shape, so the whole chain can run on the device after the batch has been
+transferred. Per-sample parameters are drawn with torch.rand on the input device; transforms
+whose kernels depend on the parameter (resampling, phase vocoder) apply them one sample at a
+time, still on the device.
+"""
+
+
+def _uniform(low, high, size, device):
+    return low + (high - low) * torch.rand(size, device=device)
+
+
+def _fit_length(waveform, length):
+    # Crop or zero-pad the time axis so that the output matches the input length
+    if waveform.shape[-1] >= length:
+        return waveform[..., :length]
+    return nn.functional.pad(waveform, (0, length - waveform.shape[-1]))
+
+
+@lru_cache(maxsize=None)
+def get_resampler(orig_freq, new_freq, device="cpu"):
+    """
+    Get a Resample transform, computing its polyphase filter only once per (orig_freq, new_freq, device).
+
+    The returned transform is shared: do not modify it.
+    """
+    return T.Resample(orig_freq, new_freq).to(device)
+
+
+def _per_sample(transform, waveform, factors):
+    # Apply transform(sample, factor) to each sample of the batch and fit the outputs to the
+    # input length, for transforms whose kernels depend on the factor
+    return torch.stack(
+        [
+            _fit_length(transform(sample, factor), waveform.shape[-1])
+            for sample, factor in zip(waveform, factors.tolist())
+        ]
+    )
+
+
+def _resample_by(waveform, ratio, max_denominator=64):
+    # Resample by new_freq / orig_freq = ratio. Approximating the ratio with a small
+    # fraction keeps the polyphase kernel small whatever the sample rate is.
+    fraction = Fraction(ratio).limit_denominator(max_denominator)
+    if fraction == 1:
+        return waveform
+    resampler = get_resampler(
+        fraction.denominator, fraction.numerator, str(waveform.device)
+    )
+    return resampler(waveform)
+
+
+class RandomGain(nn.Module):
+    """Peak-normalize each sample to a random level in dB (sox "gain -n")."""
+
+    def __init__(self, min_gain_db=-12.0, max_gain_db=0.0):
+        super().__init__()
+        self.min_gain_db = min_gain_db
+        self.max_gain_db = max_gain_db
+
+    def forward(self, waveform):
+        batch_size = waveform.shape[0]
+        gain_db = _uniform(
+            self.min_gain_db, self.max_gain_db, (batch_size, 1, 1), waveform.device
+        )
+        peak = waveform.abs().amax(dim=(1, 2), keepdim=True).clamp(min=1e-8)
+        return waveform / peak * 10 ** (gain_db / 20)
+
+
+class RandomOverdrive(nn.Module):
+    """Soft-clip each sample with a random drive in dB (sox "overdrive")."""
+
+    def __init__(self, min_drive_db=0.0, max_drive_db=30.0):
+        super().__init__()
+        self.min_drive_db = min_drive_db
+        self.max_drive_db = max_drive_db
+
+    def forward(self, waveform):
+        batch_size = waveform.shape[0]
+        drive_db = _uniform(
+            self.min_drive_db, self.max_drive_db, (batch_size, 1, 1), waveform.device
+        )
+        return torch.tanh(waveform * 10 ** (drive_db / 20))
+
+
+def _stretch(waveform, rate, n_fft, hop_length):
+    # Change the tempo by rate with a phase vocoder, keeping the pitch. The output lasts
+    # round(length / rate) samples
+    shape = waveform.shape
+    waveform = waveform.reshape(-1, shape[-1])
+    window = torch.hann_window(n_fft, device=waveform.device)
+    spec = torch.stft(
+        waveform,
+        n_fft=n_fft,
+        hop_length=hop_length,
+        window=window,
+        return_complex=True,
+    )
+    phase_advance = torch.linspace(
+        0, math.pi * hop_length, spec.shape[-2], device=waveform.device
+    )[..., None]
+    stretched = AF.phase_vocoder(spec, rate, phase_advance)
+    stretched = torch.istft(
+        stretched,
+        n_fft=n_fft,
+        hop_length=hop_length,
+        window=window,
+        length=int(round(shape[-1] / rate)),
+    )
+    return stretched.reshape(*shape[:-1], -1)
+
+
+class RandomChorus(nn.Module):
+    """Mix each sample with a copy delayed by a random, sine-modulated short delay (sox "chorus")."""
+
+    def __init__(
+        self,
+        sample_rate,
+        min_delay_ms=20.0,
+        max_delay_ms=55.0,
+        min_decay=0.1,
+        max_decay=0.9,
+        min_speed=0.1,
+        max_speed=2.0,
+        min_depth_ms=2.0,
+        max_depth_ms=5.0,
+    ):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.min_decay = min_decay
+        self.max_decay = max_decay
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.min_depth_ms = min_depth_ms
+        self.max_depth_ms = max_depth_ms
+
+    def forward(self, waveform):
+        batch_size, channels, length = waveform.shape
+        device = waveform.device
+        size = (batch_size, 1, 1)
+        delay = _uniform(self.min_delay_ms, self.max_delay_ms, size, device)
+        decay = _uniform(self.min_decay, self.max_decay, size, device)
+        speed = _uniform(self.min_speed, self.max_speed, size, device)
+        depth = _uniform(self.min_depth_ms, self.max_depth_ms, size, device)
+
+        # Fractional read position of the delayed copy, linearly interpolated
+        t = torch.arange(length, device=device)
+        modulation = 0.5 * (1 + torch.sin(2 * math.pi * speed * t / self.sample_rate))
+        position = t - (delay + depth * modulation) * self.sample_rate / 1000
+        index = position.floor().clamp(min=0, max=length - 1)
+        weight = (position - index).clamp(min=0, max=1)
+        index = index.long().expand(-1, channels, -1)
+        next_index = (index + 1).clamp(max=length - 1)
+        delayed = (1 - weight) * waveform.gather(-1, index) + weight * waveform.gather(
+            -1, next_index
+        )
+        # Silence before the start of the sample
+        delayed = delayed * (position >= 0)
+
+        return (waveform + decay * delayed) / (1 + decay)
+
+
+class RandomPitchShift(nn.Module):
+    """Shift the pitch of each sample by a random amount of cents, keeping the tempo (sox "pitch")."""
+
+    def __init__(
+        self, min_cents=-1200, max_cents=1200, n_fft=512, hop_length=128
+    ):
+        super().__init__()
+        self.min_cents = min_cents
+        self.max_cents = max_cents
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def forward(self, waveform):
+        cents = _uniform(
+            self.min_cents, self.max_cents, waveform.shape[0], waveform.device
+        )
+        rates = 2.0 ** (-cents / 1200)
+        return _per_sample(self._shift, waveform, rates)
+
+    def _shift(self, waveform, rate):
+        stretched = _stretch(waveform, rate, self.n_fft, self.hop_length)
+        return _resample_by(stretched, rate)
+
+
+class RandomTimeStretch(nn.Module):
+    """Change the tempo of each sample by a random factor, keeping the pitch (sox "stretch")."""
+
+    def __init__(self, min_factor=0.9, max_factor=1.1, n_fft=512, hop_length=128):
+        super().__init__()
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def forward(self, waveform):
+        # sox "stretch" lengthens the audio by the factor, i.e. plays it at 1 / factor
+        factors = _uniform(
+            self.min_factor, self.max_factor, waveform.shape[0], waveform.device
+        )
+        return _per_sample(
+            lambda sample, rate: _stretch(sample, rate, self.n_fft, self.hop_length),
+            waveform,
+            1 / factors,
+        )
+
+
+class RandomReverb(nn.Module):
+    """Convolve each sample with a random, exponentially decaying noise impulse response (sox "reverb")."""
+
+    def __init__(
+        self,
+        sample_rate,
+        min_reverberance=0.0,
+        max_reverberance=100.0,
+        max_rt60=1.5,
+        ir_duration=1.0,
+    ):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.min_reverberance = min_reverberance
+        self.max_reverberance = max_reverberance
+        self.max_rt60 = max_rt60
+        self.ir_length = int(ir_duration * sample_rate)
+
+    def forward(self, waveform):
+        batch_size, _, length = waveform.shape
+        device = waveform.device
+        reverberance = (
+            _uniform(
+                self.min_reverberance,
+                self.max_reverberance,
+                (batch_size, 1, 1),
+                device,
+            )
+            / 100
+        )
+
+        # Decay 60 dB over rt60 seconds
+        rt60 = 0.05 + reverberance * self.max_rt60
+        t = torch.arange(self.ir_length, device=device) / self.sample_rate
+        impulse_response = torch.randn(batch_size, 1, self.ir_length, device=device)
+        impulse_response = impulse_response * torch.exp(-6.9 * t / rt60)
+        impulse_response = impulse_response / impulse_response.norm(
+            dim=-1, keepdim=True
+        )
+
+        n_fft = length + self.ir_length - 1
+        wet = torch.fft.irfft(
+            torch.fft.rfft(waveform, n=n_fft) * torch.fft.rfft(impulse_response, n=n_fft),
+            n=n_fft,
+        )[..., :length]
+
+        mix = reverberance / 2
+        return (1 - mix) * waveform + mix * wet
+
+
+class RandomSpeed(nn.Module):
+    """Change the speed of each sample by a random factor, affecting both pitch and tempo (sox "speed")."""
+
+    def __init__(self, min_factor=0.9, max_factor=1.1):
+        super().__init__()
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+
+    def forward(self, waveform):
+        factors = _uniform(
+            self.min_factor, self.max_factor, waveform.shape[0], waveform.device
+        )
+        return _per_sample(_resample_by, waveform, 1 / factors)
+
+
+class RandomTremolo(nn.Module):
+    """Modulate the amplitude of each sample with a random sine (sox "tremolo")."""
+
+    def __init__(
+        self,
+        sample_rate,
+        min_speed=0.1,
+        max_speed=100.0,
+        min_depth=1.0,
+        max_depth=100.0,
+    ):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+
+    def forward(self, waveform):
+        batch_size, _, length = waveform.shape
+        device = waveform.device
+        speed = _uniform(self.min_speed, self.max_speed, (batch_size, 1, 1), device)
+        depth = (
+            _uniform(self.min_depth, self.max_depth, (batch_size, 1, 1), device) / 100
+        )
+        t = torch.arange(length, device=device) / self.sample_rate
+        modulation = 1 - depth * 0.5 * (1 + torch.sin(2 * math.pi * speed * t))
+        return waveform * modulation
+
+
+class RandomNoise(nn.Module):
+    """Add white noise to each sample at a random signal-to-noise ratio in dB."""
+
+    def __init__(self, min_snr_db=12.0, max_snr_db=100.0):
+        super().__init__()
+        self.min_snr_db = min_snr_db
+        self.max_snr_db = max_snr_db
+
+    def forward(self, waveform):
+        batch_size = waveform.shape[0]
+        snr_db = _uniform(
+            self.min_snr_db, self.max_snr_db, (batch_size, 1, 1), waveform.device
+        )
+        noise = torch.randn_like(waveform)
+
+        # Calculate signal and noise power
+        signal_power = waveform.pow(2).sum(dim=(1, 2), keepdim=True)
+        noise_power = noise.pow(2).sum(dim=(1, 2), keepdim=True)
+
+        # Scale the noise to the requested SNR
+        scale_factor = torch.sqrt(signal_power / (noise_power * 10 ** (snr_db / 10)))
+        return waveform + noise * scale_factor
+
+
+class RandomChunkShuffle(nn.Module):
+    """
+    Cut each sample into chunks of random duration and shuffle them, destroying the musical
+    structure while keeping the sound. Each output is one gather over the time axis.
+    """
+
+    def __init__(
+        self, sample_rate, min_chunk_duration_sec=0.05, max_chunk_duration_sec=1.0
+    ):
+        super().__init__()
+        self.min_chunk_length = int(min_chunk_duration_sec * sample_rate)
+        self.max_chunk_length = int(max_chunk_duration_sec * sample_rate)
+
+    def forward(self, waveform):
+        batch_size, channels, length = waveform.shape
+        device = waveform.device
+
+        # Generate enough random chunk lengths to cover each sample; the chunks starting past
+        # its end get an empty length and the last one is trimmed at its end
+        n_chunks = -(-length // self.min_chunk_length)
+        chunk_lengths = torch.randint(
+            self.min_chunk_length,
+            self.max_chunk_length + 1,
+            (batch_size, n_chunks),
+            device=device,
+        )
+        chunk_ends = chunk_lengths.cumsum(dim=1)
+        chunk_starts = (chunk_ends - chunk_lengths).clamp(max=length)
+        chunk_lengths = chunk_ends.clamp(max=length) - chunk_starts
+
+        # Shuffle the chunks of each sample
+        order = torch.rand(batch_size, n_chunks, device=device).argsort(dim=1)
+        chunk_starts = chunk_starts.gather(1, order)
+        chunk_lengths = chunk_lengths.gather(1, order)
+
+        # Source index of every output sample: each shuffled chunk is a run of consecutive
+        # indices starting at its original position
+        offsets = chunk_starts - (chunk_lengths.cumsum(dim=1) - chunk_lengths)
+        indices = torch.repeat_interleave(
+            offsets.flatten(),
+            chunk_lengths.flatten(),
+            output_size=batch_size * length,
+        ).view(batch_size, 1, length) + torch.arange(length, device=device)
+
+        return waveform.gather(-1, indices.expand(-1, channels, -1))
+
+
+def build_positive_augmentation(sample_rate):
+    """
+    Build the effect chain that turns an anchor batch into its positive batch.
+
+    Args:
+        sample_rate (int): Sample rate of the waveforms.
+
+    Returns:
+        nn.Sequential: The augmentation chain. It has no parameters nor buffers, so adding it
+        to a model does not change its state_dict.
+    """
+    return nn.Sequential(
+        RandomGain(),
+        RandomChorus(sample_rate),
+        RandomOverdrive(),
+        RandomPitchShift(),
+        RandomReverb(sample_rate),
+        RandomSpeed(),
+        RandomTimeStretch(),
+        RandomTremolo(sample_rate),
+        RandomNoise(),
+    )
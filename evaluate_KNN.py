@@ -1,9 +1,9 @@
 import torch
 import torchaudio
-import librosa
 import concurrent.futures
 from tqdm import tqdm
 from model import TripletNet
+from master_parser import fast_find_files
 
 
 def process_audio_file(audio_file):
@@ -60,7 +60,7 @@ print("Input audio embedding obtained: ", input_audio_embedding.shape)
 
 # Calculate the similarity between the input audio and the audio files in the folder
 folder_path = "./datasets/GTZAN/GTZAN train/blues"
-audio_files = librosa.util.find_files(
+audio_files = fast_find_files(
     folder_path,
     ext=["aac", "au", "flac", "m4a", "mp3", "ogg", "wav"],
 )
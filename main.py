@@ -80,18 +80,20 @@ def main():
             SETTING UP TRAINING PARAMETERS
             """
 
-            train.FILE_LIST_PATH = setting["FILE_LIST_PATH"]
-            train.DATASET_NAME = setting["DATASET_NAME"]
-            train.BATCH_SIZE = setting["BATCH_SIZE"]
-            train.CLIP_DURATION = setting["CLIP_DURATION"]
-            train.SAMPLE_RATE = setting["SAMPLE_RATE"]
-            train.MAX_EPOCHS = setting["MAX_EPOCHS"]
+            train_config = train.TrainConfig(
+                file_list_path=setting["FILE_LIST_PATH"],
+                dataset_name=setting["DATASET_NAME"],
+                batch_size=setting["BATCH_SIZE"],
+                clip_duration=setting["CLIP_DURATION"],
+                sample_rate=setting["SAMPLE_RATE"],
+                max_epochs=setting["MAX_EPOCHS"],
+            )
 
             """
             TRAINING THE MODEL
             """
 
-            _, best_model_path = train.main()
+            _, best_model_path = train.main(train_config)
 
             """
             SETTING UP TRAINING PARAMETERS
@@ -1,10 +1,14 @@
 import numpy as np
 import pandas as pd
-import librosa.util
+import pyarrow as pa
+import pyarrow.parquet as pq
 import torchaudio
 import os
+import functools
+import hashlib
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 """
     Audio Files Parser
@@ -19,10 +23,11 @@ from multiprocessing import Pool, cpu_count
         limit (int): Maximum number of files to consider from each directory.
         base_directory (str): Base directory containing subdirectories with audio files.
         last_file_path (str, optional): Path to the last saved CSV file for continuation. Default is None.
+        num_threads (int, optional): Number of threads reading audio file headers in each directory. Default is 64.
 
     Methods:
         worker(directory, min_duration, limit):
-            Process audio files in a directory, filtering them based on specified criteria.
+            Process audio files in a directory, filtering them based on specified criteria (see parse_directory).
 
         parse(directories=None):
             Parse audio files from specified directories. If 'last_file_path' is provided, you can continue from the last saved state.
@@ -35,11 +40,13 @@ from multiprocessing import Pool, cpu_count
     Dependencies:
         - numpy
         - pandas
-        - librosa.util
         - torchaudio
         - os
+        - pyarrow
         - tqdm
         - multiprocessing
+        - functools
+        - concurrent.futures
 
     Example:
         parser = MasterParser(
@@ -54,6 +61,142 @@ from multiprocessing import Pool, cpu_count
     """
 
 
+def fast_find_files(directory, ext, limit=None):
+    """
+    Recursively find the files in a directory with the given extensions.
+
+    Drop-in replacement for librosa.util.find_files: walks the tree with os.scandir, which
+    gets the entry types from the directory listing instead of a stat call per entry.
+
+    Args:
+        directory (str): Directory to search.
+        ext (list): File extensions to match, without the dot. Matching is case-insensitive.
+        limit (int, optional): Maximum number of files to return. Default is None (all).
+
+    Returns:
+        list: Sorted paths of the matching files.
+    """
+    extensions = {e.lower() for e in ext}
+    files = []
+    stack = [directory]
+    while stack:
+        # Like os.walk, skip the directories that cannot be read or have vanished
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                # Like os.walk, do not descend into symlinked directories
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1][1:].lower() in extensions:
+                    files.append(entry.path)
+
+    files.sort()
+    return files[:limit] if limit else files
+
+
+def to_fixed_width(file_paths):
+    """
+    Convert file paths to a fixed-width array of UTF-8 bytes.
+
+    Unlike a list of Python strings, such an array can be memory-mapped and shared between
+    processes (e.g. DataLoader workers) without touching per-object reference counts.
+
+    Args:
+        file_paths (Iterable): File paths.
+
+    Returns:
+        np.ndarray: Array of dtype "S<n>", where n is the length of the longest encoded path.
+    """
+    return np.char.encode(np.asarray(list(file_paths), dtype=str), "utf-8")
+
+
+def parse_directory(directory, name, min_duration, limit, num_threads=64):
+    """
+    Process audio files in a directory, keeping the ones lasting at least min_duration seconds.
+
+    Module-level so that the process pool does not have to pickle a MasterParser for every task.
+
+    Args:
+        directory (str): Directory to search for audio files, recursively.
+        name (str): Name of the parsing operation, used to name the progress files.
+        min_duration (float): Minimum duration (in seconds) of the audio files to keep.
+        limit (int): Maximum number of files to consider from the directory.
+        num_threads (int, optional): Number of threads reading audio file headers. Default is 64.
+
+    Returns:
+        list: Sorted paths of the kept audio files.
+    """
+    filtered_files = []
+    audio_files = fast_find_files(
+        directory, ext=["mp3", "wav", "flac", "ogg", "m4a"], limit=limit
+    )
+
+    # Progress files are per directory, as the directories are processed in parallel. Leaf
+    # names repeat across parents (e.g. artist/CD1), so tell them apart by a hash of the path
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    directory = os.path.normpath(os.path.abspath(directory))
+    directory_hash = hashlib.md5(directory.encode("utf-8")).hexdigest()[:8]
+    progress_file_name = os.path.join(
+        script_directory,
+        f"{name}_{os.path.basename(directory)}_{directory_hash}_limit={limit if limit else 'all'}_progress",
+    )
+
+    # Append the files accepted since the last tick to a Parquet file as a new row group,
+    # every 10% of the directory, instead of rewriting the whole list at every tick
+    schema = pa.schema([("file_path", pa.string())])
+    with pq.ParquetWriter(
+        progress_file_name + ".parquet", schema, compression="lz4"
+    ) as parquet_writer:
+        n_written = 0
+
+        # Reading the headers is I/O bound, so fan it out over threads
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = {
+                executor.submit(torchaudio.info, file): file
+                for file in audio_files
+            }
+            for i, future in tqdm(
+                enumerate(as_completed(futures)),
+                desc=f"Processing directory {directory}",
+                total=len(audio_files),
+            ):
+                file = futures[future]
+                try:
+                    info = future.result()
+                    min_length = int(
+                        min_duration * info.sample_rate
+                    )  # Calculate min_length based on the actual sample rate
+                    if info.num_frames >= min_length:
+                        filtered_files.append(file)
+                except Exception as e:
+                    print(f"Skipping invalid file: {file} due to error: {e}")
+
+                if (i + 1) % max(
+                    len(audio_files) // 10, 1
+                ) == 0 and n_written < len(filtered_files):
+                    parquet_writer.write_table(
+                        pa.table(
+                            {"file_path": filtered_files[n_written:]}, schema=schema
+                        )
+                    )
+                    n_written = len(filtered_files)
+
+        if n_written < len(filtered_files):
+            parquet_writer.write_table(
+                pa.table({"file_path": filtered_files[n_written:]}, schema=schema)
+            )
+
+    # Keep the output order independent of the completion order of the threads
+    filtered_files.sort()
+
+    np.save(progress_file_name + ".npy", to_fixed_width(filtered_files))
+
+    return filtered_files
+
+
 class MasterParser:
     def __init__(
         self,
@@ -62,6 +205,7 @@ class MasterParser:
         limit: int,
         base_directory: str,
         last_file_path: str = None,
+        num_threads: int = 64,
     ):
         self.name = name
         self.min_duration = min_duration
@@ -69,61 +213,13 @@ class MasterParser:
         self.base_directory = base_directory
         self.total_files = 0
         self.last_file_path = last_file_path
+        self.num_threads = num_threads
 
     def worker(self, directory, min_duration, limit):
-        filtered_files = []
-        audio_files = librosa.util.find_files(
-            directory, ext=["mp3", "wav", "flac", "ogg", "m4a"], limit=limit
+        filtered_files = parse_directory(
+            directory, self.name, min_duration, limit, self.num_threads
         )
-        for i, file in tqdm(
-            enumerate(audio_files),
-            desc=f"Processing directory {directory}",
-            total=len(audio_files),
-        ):
-            try:
-                info = torchaudio.info(file)
-                min_length = int(
-                    min_duration * info.sample_rate
-                )  # Calculate min_length based on the actual sample rate
-                if info.num_frames >= min_length:
-                    filtered_files.append(file)
-            except Exception as e:
-                print(f"Skipping invalid file: {file} due to error: {e}")
-                continue
-
-            if (i + 1) % (len(audio_files) // 10) == 0:
-                self.total_files += len(filtered_files)
-                progress = round((i + 1) / len(audio_files) * 100)
-                script_directory = os.path.dirname(os.path.abspath(__file__))
-                csv_file_name = os.path.join(
-                    script_directory,
-                    f"{self.name}_limit={self.limit if self.limit else 'all'}_progress{progress}.csv",
-                )
-                npy_file_name = os.path.join(
-                    script_directory,
-                    f"{self.name}_limit={self.limit if self.limit else 'all'}_progress{progress}.npy",
-                )
-                pd.DataFrame(filtered_files, columns=["file_path"]).to_csv(
-                    csv_file_name, index=False
-                )
-                np.save(npy_file_name, filtered_files)
-
         self.total_files += len(filtered_files)
-
-        script_directory = os.path.dirname(os.path.abspath(__file__))
-        csv_file_name = os.path.join(
-            script_directory,
-            f"{self.name}_limit={self.limit if self.limit else 'all'}_progress100.csv",
-        )
-        npy_file_name = os.path.join(
-            script_directory,
-            f"{self.name}_limit={self.limit if self.limit else 'all'}_progress100.npy",
-        )
-        pd.DataFrame(filtered_files, columns=["file_path"]).to_csv(
-            csv_file_name, index=False
-        )
-        np.save(npy_file_name, filtered_files)
-
         return filtered_files
 
     def parse(self, directories=None):
@@ -143,14 +239,26 @@ class MasterParser:
                 if os.path.isdir(os.path.join(self.base_directory, d))
             ]
 
-        with Pool(cpu_count()) as pool:
-            # Wrap the arguments for starmap with tqdm to display overall progress
-            args = [
-                (directory, self.min_duration, self.limit) for directory in directories
-            ]
-            results = list(tqdm(pool.starmap(self.worker, args), total=len(args)))
+        # Consume the directories as they are done, so that progress is reported per directory
+        # and the results do not pile up in the pool. Recycling the processes releases the
+        # caches they accumulate
+        parse_fn = functools.partial(
+            parse_directory,
+            name=self.name,
+            min_duration=self.min_duration,
+            limit=self.limit,
+            num_threads=self.num_threads,
+        )
+        filtered_files = []
+        with Pool(cpu_count(), maxtasksperchild=4) as pool:
+            for sublist in tqdm(
+                pool.imap_unordered(parse_fn, directories), total=len(directories)
+            ):
+                filtered_files.extend(sublist)
 
-        filtered_files = [file for sublist in results for file in sublist]
+        # Keep the output order independent of the completion order of the directories
+        filtered_files.sort()
+        self.total_files += len(filtered_files)
 
         if self.last_file_path is not None:
             audio_df = audio_df.append(
@@ -170,7 +278,7 @@ class MasterParser:
         )
 
         audio_df.to_csv(csv_file_name, index=False)
-        np.save(npy_file_name, filtered_files)
+        np.save(npy_file_name, to_fixed_width(audio_df["file_path"].values))
 
         print(f"Total files processed: {self.total_files}")
         print(audio_df.head())
@@ -8,6 +8,7 @@ import torch.nn as nn
 import torch.optim as optim
 import pytorch_lightning as pl
 from criterion import TripletLoss, ContrastiveLoss
+from augmentation import build_positive_augmentation, RandomChunkShuffle
 
 
 class Model(nn.Module):
@@ -103,33 +104,77 @@ class SampleCNN(Model):
 
 class TripletNet(pl.LightningModule):
     def __init__(
-        self, strides, supervised, out_dim, loss_type="triplet", *args, **kwargs
+        self,
+        strides,
+        supervised,
+        out_dim,
+        loss_type="triplet",
+        sample_rate=16000,
+        min_chunk_duration_sec=0.05,
+        max_chunk_duration_sec=1.0,
+        compile_encoder=False,
+        *args,
+        **kwargs
     ):
         super().__init__()
 
         # log hyperparameters
         self.save_hyperparameters(ignore=["encoder"])
         self.encoder = SampleCNN(strides, supervised, out_dim)
+        if compile_encoder:
+            # Compile in place so that the checkpoint keys stay the same. Needs fixed-shape
+            # batches: CUDA graphs are recorded for a single input shape
+            self.encoder.compile(mode="reduce-overhead", fullgraph=True, dynamic=False)
         self.strides = self.encoder.strides
         self.loss_type = loss_type
+        self.sample_rate = sample_rate
+        self.augmentation = build_positive_augmentation(sample_rate)
+        self.chunk_shuffle = RandomChunkShuffle(
+            sample_rate, min_chunk_duration_sec, max_chunk_duration_sec
+        )
 
     def forward(self, x):
         return self.encoder(x)
 
+    def _embed(self, x):
+        # The Trainer precision sets the autocast dtype of the encoder; the embeddings are cast
+        # back to float32 so that the losses are computed in full precision
+        return self(x).float()
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Generate the positives and negatives on the device, for the whole batch at once
+        anchor = batch
+        with torch.no_grad():
+            positive = self.augmentation(anchor)
+            negative = self.chunk_shuffle(anchor)
+
+        if self.loss_type == "triplet":
+            return anchor, positive, negative
+        elif self.loss_type == "contrastive":
+            # Pair every anchor with its positive (similar) and its negative (dissimilar)
+            sample1 = anchor.repeat_interleave(2, dim=0)
+            sample2 = torch.stack([positive, negative], dim=1).flatten(0, 1)
+            label = torch.tensor([0.0, 1.0], device=anchor.device).repeat(
+                anchor.shape[0]
+            )
+            return sample1, sample2, label
+        else:
+            raise ValueError(f"Invalid loss type: {self.loss_type}")
+
     def training_step(self, batch, batch_idx):
         if self.loss_type == "triplet":
             anchor, positive, negative = batch
-            anchor_embedding = self.encoder(anchor)
-            positive_embedding = self.encoder(positive)
-            negative_embedding = self.encoder(negative)
+            anchor_embedding = self._embed(anchor)
+            positive_embedding = self._embed(positive)
+            negative_embedding = self._embed(negative)
             loss_function = self.get_loss_function()
             train_loss = loss_function(
                 anchor_embedding, positive_embedding, negative_embedding
             )
         else:  # self.loss_type == "contrastive":
             sample1, sample2, label = batch
-            sample1_embedding = self.encoder(sample1)
-            sample2_embedding = self.encoder(sample2)
+            sample1_embedding = self._embed(sample1)
+            sample2_embedding = self._embed(sample2)
             loss_function = self.get_loss_function()
             train_loss = loss_function(sample1_embedding, sample2_embedding, label)
         # Return the loss value for logging
@@ -139,17 +184,17 @@ class TripletNet(pl.LightningModule):
     def validation_step(self, batch, batch_idx):
         if self.loss_type == "triplet":
             anchor, positive, negative = batch
-            anchor_embedding = self.encoder(anchor)
-            positive_embedding = self.encoder(positive)
-            negative_embedding = self.encoder(negative)
+            anchor_embedding = self._embed(anchor)
+            positive_embedding = self._embed(positive)
+            negative_embedding = self._embed(negative)
             loss_function = self.get_loss_function()
             val_loss = loss_function(
                 anchor_embedding, positive_embedding, negative_embedding
             )
         else:  # self.loss_type == "contrastive":
             sample1, sample2, label = batch
-            sample1_embedding = self.encoder(sample1)
-            sample2_embedding = self.encoder(sample2)
+            sample1_embedding = self._embed(sample1)
+            sample2_embedding = self._embed(sample2)
             loss_function = self.get_loss_function()
             val_loss = loss_function(sample1_embedding, sample2_embedding, label)
         self.log("val_loss", val_loss, sync_dist=True, rank_zero_only=True)
@@ -158,17 +203,17 @@ class TripletNet(pl.LightningModule):
     def test_step(self, batch, batch_idx):
         if self.loss_type == "triplet":
             anchor, positive, negative = batch
-            anchor_embedding = self.encoder(anchor)
-            positive_embedding = self.encoder(positive)
-            negative_embedding = self.encoder(negative)
+            anchor_embedding = self._embed(anchor)
+            positive_embedding = self._embed(positive)
+            negative_embedding = self._embed(negative)
             loss_function = self.get_loss_function()
             test_loss = loss_function(
                 anchor_embedding, positive_embedding, negative_embedding
             )
         else:  # self.loss_type == "contrastive":
             sample1, sample2, label = batch
-            sample1_embedding = self.encoder(sample1)
-            sample2_embedding = self.encoder(sample2)
+            sample1_embedding = self._embed(sample1)
+            sample2_embedding = self._embed(sample2)
             loss_function = self.get_loss_function()
             test_loss = loss_function(sample1_embedding, sample2_embedding, label)
         self.log("test_loss", test_loss, sync_dist=True, rank_zero_only=True)
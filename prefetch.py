@@ -0,0 +1,62 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader to copy the next batch to the GPU on a side CUDA stream while the current
+    batch is being processed, so that host-to-device copies overlap with compute.
+
+    The loader should use pinned memory, otherwise the copies cannot be asynchronous.
+
+    Args:
+        loader (Iterable): The data loader to wrap. Batches can be tensors or (nested) lists
+            and tuples of tensors.
+        device (torch.device, optional): The CUDA device to copy the batches to. Defaults to
+            the current CUDA device.
+    """
+
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = device if device else torch.device("cuda")
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.loader)
+        next_batch = self._preload(batches, stream)
+
+        while next_batch is not None:
+            # Make sure the copy of the batch has finished before it is used
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            self._record_stream(batch)
+
+            next_batch = self._preload(batches, stream)
+            yield batch
+
+    def _preload(self, batches, stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(stream):
+            return self._to_device(batch)
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.device, non_blocking=True)
+        elif isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(item) for item in batch)
+        return batch
+
+    def _record_stream(self, batch):
+        # The batch was allocated on the side stream: prevent the caching allocator from
+        # reusing its memory before the work queued on the current stream is done
+        if isinstance(batch, torch.Tensor):
+            batch.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(batch, (list, tuple)):
+            for item in batch:
+                self._record_stream(item)
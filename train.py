@@ -1,6 +1,8 @@
 import os
+from dataclasses import asdict, dataclass, field, replace
 import pandas as pd
 import numpy as np
+import torch
 from torch.utils.data import DataLoader
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint
@@ -12,6 +14,8 @@ import wandb
 from dataset import MyDataset
 from model import TripletNet
 from collate_fn import collate_fn
+from prefetch import CUDAPrefetcher
+from master_parser import to_fixed_width
 
 """
 This script demonstrates the process of training a Triplet Network using PyTorch Lightning and logging the training progress with WandB. 
@@ -23,38 +27,67 @@ Note: Make sure to replace "insert key HERE" with your actual WandB API key for
 installed and set up for this script to run successfully.
 """
 
-# Authenticate the account and initilize the project
-
-wandb.login(
-    key="insert key HERE",
-)
-
-FILE_LIST_PATH = "./datasets/MSD/MSD_audio_limit=all.csv"
-DATASET_NAME = "Million Song Dataset"
-
-BATCH_SIZE = 8
-CLIP_DURATION = 15.0
-SAMPLE_RATE = 16000
-LOSS_TYPE = "triplet"
-STRIDES = [3, 3, 3, 3, 3, 3, 3, 3, 3]
-OUT_DIM = 128
-SUPERVISED = False
-MAX_EPOCHS = 1000
-PATIENCE = 50
-LOG_EVERY_N_STEPS = 10
-PRECISION = "16-mixed"
 PROJECT_NAME = "MASTER THESIS"
-#CPU_COUNT = multiprocessing.cpu_count()
-CPU_COUNT = 16
+
+
+@dataclass
+class TrainConfig:
+    """Settings of a training run. The defaults are the ones used for the thesis."""
+
+    file_list_path: str = "./datasets/MSD/MSD_audio_limit=all.csv"
+    dataset_name: str = "Million Song Dataset"
+    batch_size: int = 8
+    clip_duration: float = 15.0
+    sample_rate: int = 16000
+    loss_type: str = "triplet"
+    strides: list = field(default_factory=lambda: [3, 3, 3, 3, 3, 3, 3, 3, 3])
+    out_dim: int = 128
+    supervised: bool = False
+    max_epochs: int = 1000
+    patience: int = 50
+    log_every_n_steps: int = 10
+    # None picks bf16-mixed if the GPU supports bfloat16, 16-mixed otherwise (see main).
+    # Resolved at run time, as querying the GPU here would initialize CUDA on import
+    precision: str = None
+    project_name: str = PROJECT_NAME
+    # cpu_count: int = multiprocessing.cpu_count()
+    cpu_count: int = 16
+    prefetch_factor: int = 4
+    # torch.compile the encoder; nn.Module.compile needs PyTorch >= 2.2
+    compile: bool = hasattr(torch.nn.Module, "compile")
+
+
+def is_same_file_list(csv_path, npy_path):
+    """
+    Check whether the NumPy file list written by MasterParser next to a CSV holds the same list.
+
+    Older versions of MasterParser only saved the files of the last run to the NumPy file when
+    resuming, so a NumPy file is only trusted if it is not older than the CSV and has as many
+    rows.
+    """
+    if not os.path.exists(npy_path):
+        return False
+    if os.path.getmtime(npy_path) < os.path.getmtime(csv_path):
+        return False
+
+    with open(csv_path) as f:
+        n_csv_rows = sum(1 for _ in f) - 1  # header
+    return np.load(npy_path, mmap_mode="r").shape[0] == n_csv_rows
 
 
 def load_file_list(file_list_path):
-    _, file_extension = os.path.splitext(file_list_path)
+    file_root, file_extension = os.path.splitext(file_list_path)
+
+    # MasterParser writes the same file list as CSV and NumPy; the latter is faster to load
+    if file_extension == ".csv" and is_same_file_list(file_list_path, file_root + ".npy"):
+        file_list_path, file_extension = file_root + ".npy", ".npy"
 
+    # Keep the paths in a NumPy array rather than a list of strings, so that the DataLoader
+    # workers share its pages instead of copying them on every reference count update
     if file_extension == ".csv":
-        file_list = pd.read_csv(file_list_path)["file_path"].tolist()
+        file_list = to_fixed_width(pd.read_csv(file_list_path)["file_path"])
     elif file_extension == ".npy":
-        file_list = np.load(file_list_path).tolist()
+        file_list = np.load(file_list_path, mmap_mode="r")
     else:
         raise ValueError(
             f"Unsupported file extension '{file_extension}'. Please use a CSV or NumPy file."
@@ -63,57 +96,79 @@ def load_file_list(file_list_path):
     return file_list
 
 
-def get_train_val_datasets(train_files, val_files):
+def get_train_val_datasets(cfg, file_list, train_indices, val_indices):
     train_set = MyDataset(
-        file_list=train_files,
-        clip_duration=CLIP_DURATION,
-        sample_rate=SAMPLE_RATE,
-        loss_type=LOSS_TYPE,
+        file_list=file_list,
+        indices=train_indices,
+        clip_duration=cfg.clip_duration,
+        sample_rate=cfg.sample_rate,
+        loss_type=cfg.loss_type,
     )
     val_set = MyDataset(
-        file_list=val_files,
-        clip_duration=CLIP_DURATION,
-        sample_rate=SAMPLE_RATE,
-        loss_type=LOSS_TYPE,
+        file_list=file_list,
+        indices=val_indices,
+        clip_duration=cfg.clip_duration,
+        sample_rate=cfg.sample_rate,
+        loss_type=cfg.loss_type,
     )
     return train_set, val_set
 
 
-def create_data_loaders(train_set, val_set):
+def create_data_loaders(cfg, train_set, val_set):
+    clip_length = int(cfg.clip_duration * cfg.sample_rate)
     train_loader = DataLoader(
         dataset=train_set,
-        batch_size=BATCH_SIZE,
+        batch_size=cfg.batch_size,
         shuffle=True,
-        collate_fn=lambda b: collate_fn(b, loss_type=train_set.loss_type),
-        num_workers=CPU_COUNT,
+        collate_fn=lambda b: collate_fn(
+            b, loss_type=train_set.loss_type, length=clip_length
+        ),
+        num_workers=cfg.cpu_count,
         drop_last=True,
         pin_memory=True,
+        pin_memory_device="cuda" if torch.cuda.is_available() else "",
+        persistent_workers=True,
+        prefetch_factor=cfg.prefetch_factor,
     )
     validation_loader = DataLoader(
         dataset=val_set,
-        batch_size=BATCH_SIZE,
+        batch_size=cfg.batch_size,
         shuffle=False,
-        collate_fn=lambda b: collate_fn(b, loss_type=val_set.loss_type),
-        num_workers=CPU_COUNT,
+        collate_fn=lambda b: collate_fn(
+            b, loss_type=val_set.loss_type, length=clip_length
+        ),
+        num_workers=cfg.cpu_count,
         drop_last=True,
         pin_memory=True,
+        pin_memory_device="cuda" if torch.cuda.is_available() else "",
+        persistent_workers=True,
+        prefetch_factor=cfg.prefetch_factor,
     )
+
+    # Overlap the host-to-device copies with compute. Only on a single GPU: with several
+    # devices Lightning has to see the DataLoaders to set up their distributed samplers
+    if torch.cuda.device_count() == 1:
+        train_loader = CUDAPrefetcher(train_loader)
+        validation_loader = CUDAPrefetcher(validation_loader)
+
     return train_loader, validation_loader
 
 
-def init_model_and_logger(config):
+def init_model_and_logger(cfg):
     model = TripletNet(
-        strides=STRIDES,
-        supervised=SUPERVISED,
-        out_dim=OUT_DIM,
-        loss_type=LOSS_TYPE,
+        strides=cfg.strides,
+        supervised=cfg.supervised,
+        out_dim=cfg.out_dim,
+        loss_type=cfg.loss_type,
+        sample_rate=cfg.sample_rate,
+        compile_encoder=cfg.compile,
     )
 
     wandb_logger = WandbLogger(
-        project=PROJECT_NAME,
+        project=cfg.project_name,
         log_model=True,
         save_dir="./wandb",
-        config=config,
+        config=asdict(cfg),
         group=None,
     )
 
@@ -139,7 +194,7 @@ class CustomModelCheckpoint(ModelCheckpoint):
         self.last_k_paths.append(self.last_model_path)
 
 
-def create_callbacks():
+def create_callbacks(cfg):
     checkpoint_callback = CustomModelCheckpoint(
         dirpath="./checkpoints",
         monitor="val_loss",
@@ -149,20 +204,20 @@ def create_callbacks():
         save_last_k=5,
     )
     early_stopping_callback = EarlyStopping(
-        monitor="val_loss", patience=PATIENCE, verbose=True, mode="min"
+        monitor="val_loss", patience=cfg.patience, verbose=True, mode="min"
     )
 
     return [early_stopping_callback, checkpoint_callback], checkpoint_callback
 
 
-def train_model(model, train_loader, validation_loader, wandb_logger):
-    callbacks, checkpoint_callback = create_callbacks()
+def train_model(cfg, model, train_loader, validation_loader, wandb_logger):
+    callbacks, checkpoint_callback = create_callbacks(cfg)
 
     trainer = Trainer(
         default_root_dir="./checkpoints",
         logger=wandb_logger,
-        max_epochs=MAX_EPOCHS,
-        precision="16-mixed" if PRECISION == "16-mixed" else 32,
+        max_epochs=cfg.max_epochs,
+        precision=cfg.precision,
         sync_batchnorm=True,
         callbacks=callbacks,
         enable_checkpointing=True,
@@ -177,29 +232,46 @@ def train_model(model, train_loader, validation_loader, wandb_logger):
     return fit, best_model_path
 
 
-def main():
-    config = {
-        "batch_size": BATCH_SIZE,
-        "clip_duration": CLIP_DURATION,
-        "sample_rate": SAMPLE_RATE,
-        "loss_type": LOSS_TYPE,
-        "strides": STRIDES,
-        "out_dim": OUT_DIM,
-        "supervised": SUPERVISED,
-        "max_epochs": MAX_EPOCHS,
-        "patience": PATIENCE,
-        "log_every_n_steps": LOG_EVERY_N_STEPS,
-        "precision": PRECISION,
-        "dataset_name": DATASET_NAME,
-    }
-
-    file_list = load_file_list(FILE_LIST_PATH)
-    train_files, val_files = train_test_split(file_list, test_size=0.2, random_state=42)
-    train_set, val_set = get_train_val_datasets(train_files, val_files)
-    train_loader, validation_loader = create_data_loaders(train_set, val_set)
-    model, wandb_logger = init_model_and_logger(config)
+def main(cfg=None):
+    """
+    Train a TripletNet with the given settings.
+
+    Args:
+        cfg (TrainConfig, optional): The settings of the run. Defaults to TrainConfig().
+
+    Returns:
+        tuple: The result of trainer.fit and the path of the best checkpoint.
+    """
+    cfg = cfg if cfg is not None else TrainConfig()
+    if cfg.precision is None:
+        # bfloat16 autocast raises on GPUs without bfloat16 support (e.g. V100, T4)
+        cfg = replace(
+            cfg,
+            precision=(
+                "bf16-mixed"
+                if torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+                else "16-mixed"
+            ),
+        )
+
+    # Authenticate the account and initilize the project
+    wandb.login(
+        key="insert key HERE",
+    )
+
+    file_list = load_file_list(cfg.file_list_path)
+    # Split indices rather than the list itself: indexing the list would copy it out of the
+    # memory map. The split is the same as splitting the list
+    train_indices, val_indices = train_test_split(
+        np.arange(len(file_list)), test_size=0.2, random_state=42
+    )
+    train_set, val_set = get_train_val_datasets(
+        cfg, file_list, train_indices, val_indices
+    )
+    train_loader, validation_loader = create_data_loaders(cfg, train_set, val_set)
+    model, wandb_logger = init_model_and_logger(cfg)
     fit, best_model_path = train_model(
-        model, train_loader, validation_loader, wandb_logger
+        cfg, model, train_loader, validation_loader, wandb_logger
     )
 
     return fit, best_model_path